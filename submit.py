@@ -6,14 +6,21 @@
 import os, os.path
 import sys
 import csv
-import glob
+import atexit
+import shlex
+import re
+import mmap
+import stat
 import fcntl
-import getpass
+import functools
 import subprocess as sp
-from datetime import datetime
-from smtplib import SMTP
 
-PYVER = sys.version_info.major
+DATE_FORMAT = "%a %b %e %H:%M:%S %Z %Y"   # Same as the output of `date'
+
+_HERE = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_LOG = os.path.normpath(os.path.join(_HERE, "..", "lib", "submit.log"))
+DEFAULT_DB  = os.path.normpath(os.path.join(_HERE, "..", "lib", "sdb", "submit.db"))
+DEFAULT_LIB = os.path.normpath(os.path.join(_HERE, "..", "lib", "scripts"))
 
 # Error codes:
 # 1 - invalid mode specified
@@ -25,13 +32,49 @@ PYVER = sys.version_info.major
 
 # Utils
 
+@functools.lru_cache(maxsize=None)
+def currentUser():
+    import getpass
+    return getpass.getuser()
+
+_LINECOUNT_CACHE = {}
+
 def countLines(filename):
+    """Returns the number of lines in `filename', counting a final line without a newline.
+Results are cached by path, modification time, and size."""
+    st = os.stat(filename)
+    key = (filename, st.st_mtime_ns, st.st_size)
+    if key in _LINECOUNT_CACHE:
+        return _LINECOUNT_CACHE[key]
     n = 0
-    with open(filename, "r") as f:
-        for _ in f:
-            n += 1
+    last = b"\n"
+    with open(filename, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            n += chunk.count(b"\n")
+            last = chunk[-1:]
+    if last != b"\n":
+        n += 1
+    _LINECOUNT_CACHE[key] = n
     return n
 
+_NL_TRANS = str.maketrans({'\n': ' ', '\r': ' '})
+
+@functools.lru_cache(maxsize=8)
+def _load_conf(path, mtime_ns):
+    """Returns the contents of configuration file `path' on a single line, and the tuple
+of options it contains. `mtime_ns' is only used as part of the cache key, so that the file
+is read again if it changes."""
+    with open(path, "r") as f:
+        opts = f.read().translate(_NL_TRANS)
+    return opts, tuple(shlex.split(opts))
+
+def buildMatcher(patterns):
+    """Returns a function that tests whether a name contains any of `patterns'
+(or always succeeds if there are no patterns)."""
+    if not patterns:
+        return lambda name: True
+    return re.compile("|".join(map(re.escape, patterns))).search
+
 def parseDirList(dl):
     dirs = []
     for d in dl.split(":"):
@@ -39,6 +82,59 @@ def parseDirList(dl):
             dirs.append(d)
     return dirs
 
+# Command-line options
+
+def _addAfter(S, a):
+    if a != "0":
+        S.afterArgs.append(a)
+
+def _setArgsArray(S, a):
+    S.fileArray = a
+    S.arrayArgs = True
+
+def _setBatchArgs(S, a):
+    S.batchFile = a
+    S.batchArgs = True
+
+def _setEmailAlways(S, a):
+    S.sendEmail = a
+    S.emailAlways = True
+
+# Options that take no value. Each action is called with the Submit object.
+FLAG_ACTIONS = {'-n':  lambda S: setattr(S, 'decorate', False),
+                '-x':  lambda S: setattr(S, 'dry', True),
+                '-d':  lambda S: setattr(S, 'debug', 1),
+                '-dd': lambda S: setattr(S, 'debug', 2),
+                '-W':  lambda S: S.coptions.append("-W")}
+
+# Options that take a value. Each action is called with the Submit object and the value.
+VALUE_ACTIONS = {'-conf':  lambda S, a: setattr(S, 'confFile', a),
+                 '-after': _addAfter,
+                 '-done':  lambda S, a: setattr(S, 'doneFile', a),
+                 '-p':     lambda S, a: setattr(S, 'comment', a),
+                 '-q':     lambda S, a: setattr(S, 'queue', a),
+                 '-t':     lambda S, a: setattr(S, 'array', a),
+                 '-T':     lambda S, a: setattr(S, 'fileArray', a),
+                 '-A':     _setArgsArray,
+                 '-F':     lambda S, a: setattr(S, 'argsFromFile', a),
+                 '-B':     _setBatchArgs,
+                 '-o':     lambda S, a: S.coptions.extend(a.split(",")),
+                 '-lib':   lambda S, a: setattr(S, 'scriptLibrary', parseDirList(a)),
+                 '-log':   lambda S, a: setattr(S, 'logFile', a),
+                 '-mode':  lambda S, a: None,   # Already processed by getMode()
+                 '-m':     lambda S, a: setattr(S, 'sendEmail', a),
+                 '-M':     _setEmailAlways,
+                 '-l':     lambda S, a: setattr(S, 'logdir', a)}
+
+HELP_OPTIONS = frozenset(["-h", "--help"])
+VIEW_OPTIONS = frozenset(["-v", "-vv", "-vvv"])
+
+# Options that select a command other than job submission.
+COMMANDS = {'-ls': "list",
+            '-w':  "lookup",
+            '-em': "email",
+            '-em-batch': "emailBatch"}
+
 # Main class
 
 class Submit():
@@ -50,60 +146,101 @@ class Submit():
     array    = None
     comment  = None
     queue    = None
-    coptions = []            # From cmdline -o option
+    coptions = None            # From cmdline -o option
     foptions = None            # From confFile
+    foptionsList = None        # Options in confFile, parsed with shlex
     fileArray = None           # from -T
     arrayArgs = False          # Set by -A
     argsFromFile = False       # Set by -F
+    batchArgs = False          # Set by -B
+    batchFile = None           # Argument of -B
+    batchRows = None           # Rows of argsFromFile, when batchArgs is set
     sendEmail = False          # Set by -m
     emailAlways = False        # If True, send email also for successful jobs (set by -M)
     logdir = False             # Directory where .IN.o and .IN.e files are written
+    env = None                 # Environment for the submission command (None = inherit)
+
+    # Trailer added to decorated scripts. `done' and `email' are the optional -done and -m/-M lines.
+    footerTemplate = """_RETCODE=$?
+{done}if [ -n "$BASH_VERSION" ]; then printf -v _SUBMIT_TS2 '%(%s)T' -1; printf '%%Terminated: %({date})T\\n' $_SUBMIT_TS2; else echo %Terminated: `date`; _SUBMIT_TS2=$(date +%s); fi
+echo %Elapsed: $(($_SUBMIT_TS2 - $_SUBMIT_TS)) seconds
+{email}exit $_RETCODE
+"""
     
     confFile  = ".sbatchrc"
-    logFile   = os.path.dirname(__file__) + "/../lib/submit.log"
-    dbFile    = os.path.dirname(__file__) + "/../lib/sdb/submit.db"
+    logFile   = DEFAULT_LOG
+    dbFile    = DEFAULT_DB
     useDB     = True
-    trueArgs  = []
-    afterArgs = []
-    scriptLibrary = []
+    trueArgs  = None
+    afterArgs = None
+    scriptLibrary = None
     
     def __init__(self, mode):
         self.mode = mode
-        self.confFile = DEFAULTS[mode]['conf']
+        d = DEFAULTS[mode]
+        self.confFile = d['conf']
+        self._dirtag = d['directive']
+        self._jobidvar = d['jobid']
+        self._subcmd = d['command']
+        self.coptions = []
+        self.trueArgs = []
+        self.afterArgs = []
+        self.foptions = None
+        self.doneFile = None
+        self.array = None
+        self.comment = None
+        self.queue = None
         submitlib = os.getenv("SUBMIT_LIB")
         if submitlib:
             self.scriptLibrary = parseDirList(submitlib)
         else:
-            self.scriptLibrary = [os.path.dirname(__file__) + "/../lib/scripts/"]
+            self.scriptLibrary = [DEFAULT_LIB]
+        self._pending_log = []
+        atexit.register(self.flushLog)
 
     def dump(self):
-        for a in ['mode', 'dry', 'decorate', 'doneFile', 'array', 'comment', 'queue', 'coptions', 'foptions', 'confFile', 'scriptLibrary', 'logFile', 'afterArgs', 'trueArgs']:
-            sys.stderr.write("{} = {}\n".format(a, getattr(self, a)))
+        attrs = ['mode', 'dry', 'decorate', 'doneFile', 'array', 'comment', 'queue', 'coptions', 'foptions', 'confFile', 'scriptLibrary', 'logFile', 'afterArgs', 'trueArgs']
+        sys.stderr.write("".join([ "{} = {}\n".format(a, getattr(self, a)) for a in attrs ]))
 
     def writeLogEntry(self, script, jobid):
-        """Write a log entry to the logFile to record that `script' was called. Uses locking."""
-        now = datetime.now()
+        """Record that `script' was submitted with id `jobid'. Entries are buffered and
+written to the logFile by flushLog()."""
+        if not self.logFile:
+            return
+        from datetime import datetime
+        now = datetime.now().isoformat('\t')
         scriptname = os.path.split(script)[1]
-        cwd = os.getcwd()
+        self._pending_log.append(f"{now}\t{jobid}\t{currentUser()}\t{scriptname}\t{os.getcwd()}\n")
+
+    def flushLog(self):
+        """Write all pending log entries to the logFile with a single O_APPEND write, holding
+an exclusive lock so that entries from concurrent submit processes are not interleaved
+(O_APPEND alone is not atomic on NFS)."""
+        if not self._pending_log:
+            return
+        entries = "".join(self._pending_log)
+        self._pending_log = []
         try:
-            with open(self.logFile, "a") as f:
-                fcntl.flock(f,fcntl.LOCK_EX)
-                try:
-                    f.write(now.isoformat('\t') + '\t' + str(jobid) + "\t" + getpass.getuser() + '\t' + scriptname + "\t" + cwd + '\n')
-                finally:
-                    fcntl.flock(f,fcntl.LOCK_UN)
-        except:
-            sys.stderr.write("Warning: log file `{}' does not exist or is not writable.\n".format(self.logFile))
+            entries = entries.encode(errors="surrogateescape")   # cwd may not be valid UTF-8
+            fd = os.open(self.logFile, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX)
+                os.write(fd, entries)
+                fcntl.flock(fd, fcntl.LOCK_UN)
+            finally:
+                os.close(fd)
+        except OSError as e:
+            sys.stderr.write("Warning: log file `{}' not writable: {}\n".format(self.logFile, e))
 
     def usage(self):
         if self.mode == "slurm":
             fargs = {'progname': sys.argv[0],
-                     'sub': "sbatch",
+                     'sub': self._subcmd,
                      'args': "$1, $2, $3, etc",
                      'conf': self.confFile}
         elif self.mode == "pbs":
             fargs = {'progname': sys.argv[0],
-                     'sub': "squeue",
+                     'sub': self._subcmd,
                      'args': "$arg1, $arg2, $arg3, etc",
                      'conf': self.confFile}
 
@@ -163,6 +300,11 @@ Submit options (should be BEFORE script name):
               | the script will be invoked with five arguments, two read from argfile
               | and the remaining three fixed.
 
+ -B argfile   | Like -F, but submits a single job array with one task for each row
+              | of `argfile', instead of one job for each row. If the array cannot be
+              | submitted, falls back to one job for each row. Cannot be combined with
+              | -F, -t, -T, -A, or -n. Only available in slurm mode.
+
  -W           | Cause submit to wait until the job is done before returning.
 
  -o options   | Pass `options' to the {sub} command-line. The options should be 
@@ -186,7 +328,10 @@ Submit options (should be BEFORE script name):
               | command-line option takes precedence over the environment variable.
 
  -log logfile | Record job submissions to `logfile'. Default: "../lib/submit.log"
-              | (relative to location of this command).
+              | (relative to location of this command). Use -log "" to disable
+              | logging. With -n and -log "" (and no -F or -B) the script is handed
+              | to {sub} directly, and its output is printed unchanged: this may
+              | include a cluster name after the job id (e.g. "1234;cluster").
 
  -l directory | Directory where the stdout and stderr files are written. Defaults
               | to a subdirectory called 'log' of the current directory, if it
@@ -229,95 +374,35 @@ Configuration:
 
     def parseArgs(self, args):
         mode = "submit"
-        after = False
-        prev = ""
-        valuedArgs = ['-v', '-vv', '-vvv', '-conf', '-after', '-done', '-n', '-p', '-q', '-t', '-T', '-A', '-F', '-o', '-lib', '-log', '-mode', '-m', '-M', '-l']
 
         if args == []:
             self.usage()
             return False
 
-        for a in args:
-            if after:
-                self.trueArgs.append(a)
+        it = iter(args)
+        for a in it:
+            if a in COMMANDS:
+                mode = COMMANDS[a]
+            elif a in HELP_OPTIONS:
+                self.usage()
+                return False
+            elif a in VIEW_OPTIONS:
+                script = next(it, None)
+                if script is None:
+                    break
+                self.viewScript(script, a)
+                return False
+            elif a in FLAG_ACTIONS:
+                FLAG_ACTIONS[a](self)
+            elif a in VALUE_ACTIONS:
+                value = next(it, None)
+                if value is None:
+                    break
+                VALUE_ACTIONS[a](self, value)
             else:
-                if a == "-ls":
-                    mode = "list"
-                elif a == "-w":
-                    mode = "lookup"
-                elif a == "-em":
-                    mode = "email"
-                elif a == "-n":
-                    self.decorate = False
-                elif a == "-x":
-                    self.dry = True
-                elif a == "-d":
-                    self.debug = 1
-                elif a == "-dd":
-                    self.debug = 2
-                elif a in ["-h", "--help"]:
-                    self.usage()
-                    return False
-                elif prev == "-mode":
-                    prev = ""   # -mode has already been processed
-                elif prev in ['-v', '-vv', '-vvv']:
-                    self.viewScript(a, prev)
-                    return False
-                elif prev == "-conf":
-                    self.confFile = a
-                    prev = ""
-                elif prev == "-after":
-                    if a != "0":
-                        self.afterArgs.append(a)
-                    prev = ""
-                elif prev == "-done":
-                    self.doneFile = a
-                    prev = ""
-                elif prev == "-p":
-                    self.comment = a
-                    prev = ""
-                elif prev == "-q":
-                    self.queue = a
-                    prev = ""
-                elif prev == "-t":
-                    self.array = a
-                    prev = ""
-                elif prev == "-T":
-                    self.fileArray = a
-                    prev = ""
-                elif prev == "-A":
-                    self.fileArray = a
-                    self.arrayArgs = True
-                    prev = ""
-                elif prev == "-F":
-                    self.argsFromFile = a
-                    prev = ""
-                elif prev == "-o":
-                    self.coptions.append(a.replace(",", " "))
-                    prev = ""
-                elif prev == "-lib":
-                    self.scriptLibrary = parseDirList(a)
-                    prev = ""
-                elif prev == "-log":
-                    self.logFile = a
-                    prev = ""
-                elif prev == "-m":
-                    self.sendEmail = a
-                    prev = ""
-                elif prev == "-M":
-                    self.sendEmail = a
-                    self.emailAlways = True
-                    prev = ""
-                elif prev == '-l':
-                    self.logdir = a
-                    prev = ""
-                elif a in valuedArgs:
-                    prev = a 
-                elif a == "-W":
-                    self.coptions.append("-W")
-                else:
-                    self.trueArgs.append(a)
-                    after = True
+                self.trueArgs.append(a)
+                self.trueArgs.extend(it)
+                break
 
         if mode == "list":
             self.listScripts(self.trueArgs)
@@ -331,9 +416,34 @@ Configuration:
             self.sendNotification(self.trueArgs)
             return False
 
+        if mode == "emailBatch":
+            self.sendNotifications(sys.stdin)
+            return False
+
+        if self.batchArgs:
+            if self.argsFromFile:
+                sys.stderr.write("Error: -B cannot be combined with -F, -t, -T, -A, or -n.\n")
+                sys.exit(4)
+            self.argsFromFile = self.batchFile
+
         if self.argsFromFile and not os.path.isfile(self.argsFromFile):
             sys.stderr.write("Error: file `{}' does not exist.\n".format(self.argsFromFile))
             sys.exit(3)
+
+        if self.batchArgs:
+            if self.mode != "slurm":
+                sys.stderr.write("Error: -B is only supported in slurm mode.\n")
+                sys.exit(4)
+            if self.array or self.fileArray or not self.decorate:
+                sys.stderr.write("Error: -B cannot be combined with -F, -t, -T, -A, or -n.\n")
+                sys.exit(4)
+            # Parsed the same way as -F, so that empty and quoted fields are preserved
+            with open(self.argsFromFile, "r") as f:
+                self.batchRows = list(csv.reader(f, delimiter='\t'))
+            if not self.batchRows:
+                sys.stderr.write("Error: file `{}' is empty.\n".format(self.argsFromFile))
+                sys.exit(3)
+            self.array = "1-" + str(len(self.batchRows))
         
         if self.fileArray:
             parts = self.fileArray.split("%")
@@ -358,64 +468,83 @@ Configuration:
     def readOptions(self):
         optpath = os.path.expanduser("~/" + self.confFile)
         #sys.stderr.write("Reading options from " + optpath + "\n")
-        if os.path.isfile(optpath):
-            with open(optpath, 'r') as f:
-                opts = f.read()
-            opts = opts.replace('\n', ' ')
-            self.foptions = opts.replace('\r', ' ')
+        try:
+            st = os.stat(optpath)
+        except OSError:
+            return self.foptions
+        if stat.S_ISREG(st.st_mode):
+            self.foptions, foptionsList = _load_conf(optpath, st.st_mtime_ns)
+            self.foptionsList = list(foptionsList)
             #sys.stderr.write("Read: " + self.foptions + "\n")
         return self.foptions
 
-    def setVars(values):
-        idx = 1
-        names = ["args"]
-        os.putenv("args", " ".join(values))
-        
-        for v in values:
-            name = "arg" + str(idx)
-            os.putenv(name, v)
-            names.append(name)
-            idx = idx + 1
-
-        return names
+    def setVars(self, values):
+        """Returns a copy of the environment in which `args' contains all `values', and
+`arg1', `arg2', etc contain each of them."""
+        env = os.environ.copy()
+        env["args"] = " ".join(values)
+        for i, v in enumerate(values, 1):
+            env["arg{}".format(i)] = v
+        return env
 
     def decorateScript(self, infile, out):
-        dirtag = DEFAULTS[self.mode]['directive']
-        inHeader = True
-        with open(infile, "r") as inf:
-            for row in inf:
-                if inHeader:
-                    srow = row.strip()
-                    if len(srow) == 0 or srow.startswith("#!") or srow.startswith(dirtag):
-                        pass
-                    else:
-                        inHeader = False
-                        out.write("\necho %Commandline: " + " ".join(self.trueArgs) + "\n")
-                        out.write("echo %Started: `date`\n")
-                        out.write("_ORIG_PWD=$PWD\n")
-                        out.write("_SUBMIT_TS=$(date +%s)\n\n")
-                        if self.fileArray:
-                            if self.arrayArgs:
-                                out.write("""JOB_FILEARRAY_ARGS=($(sed "${{SLURM_ARRAY_TASK_ID}}q;d" {}))\n""".format(self.fileArray))
-                            else:
-                                out.write("""JOB_FILEARRAY_LINE=$(sed "${{SLURM_ARRAY_TASK_ID}}q;d" {})\n""".format(self.fileArray))
-                out.write(row)
-            out.write("_RETCODE=$?\n")
-            if self.doneFile:
-                p = self.doneFile.find("@")
-                if p >= 0:
-                    self.doneFile = self.doneFile[0:p] + DEFAULTS[self.mode]['jobid'] + self.doneFile[p+1:]
-                #out.write("touch " + self.doneFile + "\n")
-                out.write("echo $_RETCODE > {}\n".format(self.doneFile))
-            out.write("echo %Terminated: `date`\n")
-            out.write("_SUBMIT_TS2=$(date +%s)\n")
-            out.write("echo %Elapsed: $(($_SUBMIT_TS2 - $_SUBMIT_TS)) seconds\n")
-            if self.sendEmail:
-                if self.emailAlways:
-                    out.write("""{}/submit -em {} $SLURM_JOB_ID $_RETCODE $(($_SUBMIT_TS2 - $_SUBMIT_TS)) $_ORIG_PWD "{}"\n""".format(os.path.dirname(__file__), self.sendEmail, " ".join(self.trueArgs)))
+        """Write script `infile' to the binary stream `out', adding the decoration after the header."""
+        out.write(self.buildDecorated(infile))
+
+    def buildDecorated(self, infile):
+        """Returns the contents of script `infile' with the decoration added, as bytes."""
+        headerPrefixes = (b"#!", self._dirtag.encode())
+        cmdline = " ".join([ shlex.quote(a) for a in self.trueArgs ])
+        with open(infile, "rb") as inf:
+            data = inf.read().replace(b"\r\n", b"\n")   # sbatch rejects DOS line breaks
+        parts = [data]
+        pos = 0
+        while pos < len(data):
+            eol = data.find(b"\n", pos) + 1 or len(data)
+            row = data[pos:eol]
+            srow = row if row[:1] == b"#" else row.lstrip()
+            if len(srow) == 0 or srow.startswith(headerPrefixes):
+                pos = eol
+                continue
+            # First row after the header: insert decoration before it, keep the rest of the script as is
+            deco = ["\necho %Commandline: " + cmdline + "\n",
+                    "_ORIG_PWD=$PWD\n",
+                    "if [ -n \"$BASH_VERSION\" ]; then printf -v _SUBMIT_TS '%(%s)T' -1; printf '%%Started: %(" + DATE_FORMAT + ")T\\n' $_SUBMIT_TS; else echo %Started: `date`; _SUBMIT_TS=$(date +%s); fi\n\n"]
+            if self.fileArray:
+                if self.arrayArgs:
+                    deco.append("""JOB_FILEARRAY_ARGS=($(sed "${{SLURM_ARRAY_TASK_ID}}q;d" {}))\n""".format(self.fileArray))
                 else:
-                    out.write("""if [[ "$_RETCODE" != "0" ]]; then {}/submit -em {} $SLURM_JOB_ID $_RETCODE $(($_SUBMIT_TS2 - $_SUBMIT_TS)) $ORIG_PWD "{}"; fi\n""".format(os.path.dirname(__file__), self.sendEmail, " ".join(self.trueArgs)))
-            out.write("exit $_RETCODE\n")
+                    deco.append("""JOB_FILEARRAY_LINE=$(sed "${{SLURM_ARRAY_TASK_ID}}q;d" {})\n""".format(self.fileArray))
+            if self.batchArgs:
+                deco.append('case "$SLURM_ARRAY_TASK_ID" in\n')
+                for i, row in enumerate(self.batchRows, 1):
+                    deco.append("{}) {} ;;\n".format(i, " ".join(["set", "--"] + [ shlex.quote(a) for a in row ] + ['"$@"'])))
+                deco.append("esac\n")
+            parts = [data[:pos], "".join(deco).encode(), data[pos:]]
+            break
+        done = ""
+        if self.doneFile:
+            p = self.doneFile.find("@")
+            if p >= 0:
+                self.doneFile = self.doneFile[0:p] + self._jobidvar + self.doneFile[p+1:]
+            done = "echo $_RETCODE > {}\n".format(self.doneFile)
+        email = ""
+        if self.sendEmail:
+            if self.emailAlways:
+                email = """{}/submit -em {} $SLURM_JOB_ID $_RETCODE $(($_SUBMIT_TS2 - $_SUBMIT_TS)) $_ORIG_PWD {}\n""".format(_HERE, self.sendEmail, shlex.quote(cmdline))
+            else:
+                email = """if [[ "$_RETCODE" != "0" ]]; then {}/submit -em {} $SLURM_JOB_ID $_RETCODE $(($_SUBMIT_TS2 - $_SUBMIT_TS)) $ORIG_PWD {}; fi\n""".format(_HERE, self.sendEmail, shlex.quote(cmdline))
+        parts.append(self.footerTemplate.format(done=done, email=email, date=DATE_FORMAT).encode())
+        return b"".join(parts)
+
+    def isDecorated(self, script):
+        """Returns True if `script' ends with the trailer written by decorateScript(). Only
+the last KB of the file is examined."""
+        with open(script, "rb") as f:
+            size = os.fstat(f.fileno()).st_size
+            f.seek(max(0, size - 1024))
+            tail = f.read()
+        return tail.endswith(b"exit $_RETCODE\n") and b"_RETCODE=$?\n" in tail
 
     def resolveScriptName(self, scriptName):
         if os.path.isfile(scriptName):
@@ -427,7 +556,10 @@ Configuration:
         sys.stderr.write("Error: script `{}' not found either in current directory or in script library!\n(Script library: {})\n".format(scriptName, self.scriptLibrary))
         sys.exit(5)
 
-    def makeCmdline(self):
+    def makeCmdline(self, script="/dev/stdin", row=()):
+        """Returns the submission command as a list of arguments, and the list of arguments
+to be passed to the script (the -F `row', if any, followed by the command line arguments).
+By default the script is read from standard input."""
         origName = self.trueArgs[0]
         filename = os.path.split(origName)[1]
         if self.logdir:
@@ -435,84 +567,127 @@ Configuration:
         else:
             logdir = "log/" if os.path.isdir("log") else ""
         # print (name, origName, filename)
-        cmdline = 'sbatch --parsable -D "`pwd`" -J ' + origName
+        cmdline = [self._subcmd, "--parsable", "-D", os.getcwd(), "-J", origName]
         if self.array:
-            cmdline += " -o {}{}.o%A_%a -e {}{}.e%A_%a -a {}".format(logdir, filename, logdir, filename, self.array)
+            cmdline += ["-o", "{}{}.o%A_%a".format(logdir, filename), "-e", "{}{}.e%A_%a".format(logdir, filename), "-a", self.array]
         else:
-            cmdline += " -o {}{}.IN.o%j -e {}{}.IN.e%j".format(logdir, filename, logdir, filename)
+            cmdline += ["-o", "{}{}.IN.o%j".format(logdir, filename), "-e", "{}{}.IN.e%j".format(logdir, filename)]
         if self.comment:
-            cmdline += ' --comment "{}"'.format(self.comment)
+            cmdline += ["--comment", self.comment]
         if self.afterArgs:
             aspecs = [ "afterok:" + a for a in self.afterArgs ]
-            cmdline += " -d " + ",".join(aspecs)
+            cmdline += ["-d", ",".join(aspecs)]
         if self.queue:
-            cmdline += " -A " + self.queue
-        if self.foptions:
-            cmdline += " " + self.foptions
+            cmdline += ["-A", self.queue]
+        if self.foptionsList:
+            cmdline += self.foptionsList
         if self.coptions:
-            cmdline += " " + " ".join(self.coptions)
-
-        for i in range(len(self.trueArgs)):
-            if " " in self.trueArgs[i]:
-                self.trueArgs[i] = '"' + self.trueArgs[i] + '"'
-
-        #return cmdline + " /dev/stdin " + fileargs + " " + " ".join(self.trueArgs[1:])
-        return cmdline + " /dev/stdin ",  " ".join(self.trueArgs[1:])
+            cmdline += self.coptions
+        cmdline.append(script)
+        return cmdline, list(row) + self.trueArgs[1:]
 
     def doCollect(self, jobid, name, arg1):
-        cmdline = "scollect.py submit -db {} {} {} {}".format(self.dbFile, jobid, name, arg1)
+        cmdline = ["scollect.py", "submit", "-db", self.dbFile, str(jobid), name, arg1]
         try:
-            subprocess.check_output(cmdline, shell=True)
-        except:
+            sp.check_output(cmdline)
+        except (sp.CalledProcessError, FileNotFoundError):
             pass
 
-    def submitScript(self, cmdline, script):
-        if PYVER == 3:
-            proc = sp.Popen(cmdline, shell="True", stdin=sp.PIPE, stdout=sp.PIPE, stderr=sp.PIPE, encoding='utf8')
-        else:
-            proc = sp.Popen(cmdline, shell="True", stdin=sp.PIPE, stdout=sp.PIPE, stderr=sp.PIPE)
+    def submitScript(self, cmdline, script, fatal=True):
+        """Submit `script' using `cmdline' and return its job id. On failure, exits with
+code 2 if `fatal' is True, otherwise returns 0."""
         if self.decorate:
-            self.decorateScript(script, proc.stdin)
+            payload = self.buildDecorated(script)
         else:
-            with open(script, "r") as f:
-                proc.stdin.write(f.read())
-        proc.stdin.close()
-        proc.wait()
-        result = proc.stdout.readline().rstrip("\r\n")
-        error = proc.stderr.read()
+            with open(script, "rb") as f:
+                payload = f.read().replace(b"\r\n", b"\n")
+        proc = sp.Popen(cmdline, stdin=sp.PIPE, stdout=sp.PIPE, stderr=sp.PIPE, env=self.env)
+        result, error = proc.communicate(input=payload)
+        result = result.decode().strip()
         if error:
-            sys.stderr.write(error)
-            sys.exit(2)
+            sys.stderr.write(error.decode(errors="replace"))
+        if proc.returncode != 0 or not result:
+            if fatal:
+                sys.exit(2)
             return 0
-        return int(result)
+        return int(result.split(";")[0])       # --parsable prints jobid[;cluster]
 
     def main(self):
         origScript = self.resolveScriptName(self.trueArgs[0])
         if origScript:
             self.readOptions()
-            cmdline1, cmdline2 = self.makeCmdline()
+            # Re-submitting a decorated script: nothing to add unless we need the -done, email, or file array lines
+            if self.decorate and not (self.doneFile or self.sendEmail or self.fileArray or self.batchArgs) and self.isDecorated(origScript):
+                self.decorate = False
+            if self.passthrough() and not self.hasDosLineBreaks(origScript):
+                cmdline1, cmdline2 = self.makeCmdline(origScript)
+                self.exec_submit(cmdline1 + cmdline2)
+                return
+            if self.batchArgs and self.submitArray(origScript):
+                self.flushLog()
+                return
             if self.argsFromFile:
                 with open(self.argsFromFile, "r") as f:
                     c = csv.reader(f, delimiter='\t')
                     for row in c:
-                        fargs = " ".join(row)
-                        self.do_submit(cmdline1 + fargs + " " + cmdline2, origScript)
+                        cmdline1, cmdline2 = self.makeCmdline(row=row)
+                        self.do_submit(cmdline1 + cmdline2, origScript)
             else:
+                cmdline1, cmdline2 = self.makeCmdline()
                 self.do_submit(cmdline1 + cmdline2, origScript)
+            self.flushLog()
+
+    def submitArray(self, origScript):
+        """Submit a single job array with one task for each row of argsFromFile (-B). Returns
+False if submission failed, in which case batchArgs is cleared so that the rows can be
+submitted as separate jobs."""
+        cmdline1, cmdline2 = self.makeCmdline()
+        if self.do_submit(cmdline1 + cmdline2, origScript, fatal=False) or self.dry:
+            return True
+        sys.stderr.write("Warning: array submission failed, submitting one job for each row of `{}'.\n".format(self.argsFromFile))
+        self.batchArgs = False
+        self.array = None
+        return False
+
+    def hasDosLineBreaks(self, script):
+        """Returns True if `script' contains CRLF line breaks, which have to be converted
+before submission (so the script cannot be handed to the scheduler as is)."""
+        with open(script, "rb") as f:
+            return b"\r\n" in f.read()
+
+    def passthrough(self):
+        """Returns True if there is nothing left to do after the submission command returns:
+the script is not decorated, no log entry is written, and only one job is submitted."""
+        return not (self.decorate or self.logFile or self.argsFromFile) and self.debug < 2
 
-    def do_submit(self, cmdline, origScript):
+    def exec_submit(self, cmdline):
+        """Replace this process with the submission command, which reads the script directly
+and prints the job id itself."""
         if self.debug > 0:
-            sys.stderr.write("Executing: " + cmdline + "\n")
+            sys.stderr.write("Executing: " + " ".join([ shlex.quote(a) for a in cmdline ]) + "\n")
+        if not self.dry:
+            if not os.access(".", os.X_OK | os.W_OK):
+                sys.stderr.write("Warning: current directory is not writeable, log files for this job will not be created.\n")
+            sys.stdout.flush()
+            sys.stderr.flush()
+            os.execvpe(cmdline[0], cmdline, self.env or os.environ)
+
+    def do_submit(self, cmdline, origScript, fatal=True):
+        if self.debug > 0:
+            sys.stderr.write("Executing: " + " ".join([ shlex.quote(a) for a in cmdline ]) + "\n")
         if self.debug > 1:
-            self.decorateScript(origScript, sys.stderr)
+            sys.stderr.flush()
+            self.decorateScript(origScript, sys.stderr.buffer)
             self.dry = True
         if not self.dry:
             if not os.access(".", os.X_OK | os.W_OK):
                 sys.stderr.write("Warning: current directory is not writeable, log files for this job will not be created.\n")
-            jobid = self.submitScript(cmdline, origScript)
+            jobid = self.submitScript(cmdline, origScript, fatal)
             if jobid > 0:
                 sys.stdout.write(str(jobid) + "\n")
                 self.writeLogEntry(origScript, jobid)
+            return jobid
+        return 0
 
     # def main(self):
     #     (origScript, decScript) = self.resolveScriptName(self.trueArgs[0])
@@ -543,24 +718,20 @@ Configuration:
     ### Additional commands
 
     def listScripts(self, patterns=[]):
+        pred = buildMatcher(patterns)
+        out = []
         for lib in self.scriptLibrary:
-            files = glob.glob("{}/*.qsub".format(lib))
+            try:
+                with os.scandir(lib) as it:
+                    files = [ e.name for e in it if e.name.endswith(".qsub") and pred(e.name) and e.is_file() ]
+            except OSError:
+                continue
             if files:
-                files = [ os.path.split(f)[1] for f in files ]
                 files.sort()
-                sys.stdout.write("Scripts in {}:\n".format(lib))
-                for f in files:
-                    if self.matches(f, patterns):
-                        sys.stdout.write("  " + f + "\n")
-                sys.stdout.write("\n")
-
-    def matches(self, name, patterns):
-        if not patterns:
-            return True
-        for p in patterns:
-            if p in name:
-                return True
-        return False
+                out.append("Scripts in {}:\n".format(lib))
+                out.extend([ "  " + f + "\n" for f in files ])
+                out.append("\n")
+        sys.stdout.writelines(out)
 
     def readScriptInfo(self, filename):
         desc = ""
@@ -586,27 +757,47 @@ Configuration:
             mode = arg.count("v")
             if mode == 3:
                 with open(orig, "r") as f:
-                    sys.stdout.write(f.read())
-                    sys.stdout.write("\n")
+                    sys.stdout.write(f.read() + "\n")
                 return
             (desc, args) = self.readScriptInfo(orig)
-            sys.stdout.write("{} - {}\n".format(script, desc))
+            out = ["{} - {}\n".format(script, desc)]
             if mode == 2:
-                sys.stdout.write("Arguments:\n")
-                for a in args:
-                    sys.stdout.write(" " + a)
+                out.append("Arguments:\n")
+                out.extend([ " " + a for a in args ])
+            sys.stdout.write("".join(out))
 
     def lookupJobs(self, jobids):
-        sp.call("for j in {}; do grep -w $j {}; done".format(" ".join(jobids), self.logFile), shell=True)
-
-    def sendNotification(self, args):
-        email, jobid, retcode, seconds, pwd, cmdline = args
-        S = SMTP("smtp.ufl.edu")
+        """Print all lines of the logFile that contain one of `jobids' as a word, in a single pass."""
+        if not jobids:
+            return
+        pat = re.compile(rb"\b(" + b"|".join([ re.escape(os.fsencode(j)) for j in jobids ]) + rb")\b")
+        found = []
+        try:
+            with open(self.logFile, "rb") as f:
+                if os.fstat(f.fileno()).st_size == 0:
+                    return
+                with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                    end = 0
+                    for m in pat.finditer(mm):
+                        if m.start() < end:   # Line already printed
+                            continue
+                        start = mm.rfind(b"\n", 0, m.start()) + 1
+                        end = mm.find(b"\n", m.end()) + 1 or len(mm)
+                        found.append(mm[start:end])
+        except (IOError, OSError):
+            sys.stderr.write("Warning: log file `{}' does not exist or is not readable.\n".format(self.logFile))
+            return
+        if found and not found[-1].endswith(b"\n"):
+            found.append(b"\n")
+        sys.stdout.flush()
+        sys.stdout.buffer.write(b"".join(found))
+
+    def notificationMessage(self, email, jobid, retcode, seconds, pwd, cmdline):
         succ = "success" if retcode == "0" else "failed"
-        body = f"""Subject: Job {jobid}: {succ}
+        return f"""Subject: Job {jobid}: {succ}
 From: {email}
 To: {email}
-Content-type: text/html
+Content-type: text/html; charset=utf-8
 
 <!DOCTYPE html>
 <HTML>
@@ -622,42 +813,63 @@ Content-type: text/html
 </HTML>
 
 """
-        S.sendmail(email, email, body)
+
+    def sendNotification(self, args):
+        from smtplib import SMTP
+
+        email = args[0]
+        S = SMTP("smtp.ufl.edu")
+        S.sendmail(email, email, self.notificationMessage(*args).encode("utf-8"))
+
+    def sendNotifications(self, stream):
+        """Send a notification for each line of `stream', which should contain the six arguments
+of -em as a JSON list. All messages are sent over a single SMTP connection."""
+        import json
+        from smtplib import SMTP, SMTPException
+
+        S = SMTP("smtp.ufl.edu")
+        try:
+            for n, line in enumerate(stream, 1):
+                if not line.strip():
+                    continue
+                try:
+                    args = json.loads(line)
+                    if not isinstance(args, list) or len(args) != 6 or not all(isinstance(a, str) for a in args):
+                        raise ValueError("expected a list of six strings")
+                    body = self.notificationMessage(*args).encode("utf-8")
+                    S.sendmail(args[0], args[0], body)
+                except (ValueError, TypeError, SMTPException) as e:
+                    sys.stderr.write("Warning: skipping notification on line {}: {}\n".format(n, e))
+        finally:
+            S.quit()
 
 ### PBS support
 
 class SubmitPBS(Submit):
-    varNames = []
-
-    def setVars(self):
-        subargs = self.trueArgs[1:]
-        self.varNames.append("args")
-        os.putenv("args", " ".join(subargs))
-        idx = 1
-        for arg in subargs:
-            name = "arg{}".format(idx)
-            self.varNames.append(name)
-            os.putenv(name, arg)
-            idx += 1
-
-    def makeCmdline(self, name):
-        self.setVars()
-        cmdline = 'qsub -d "`pwd`"'
+    varNames = None
+
+    def makeCmdline(self, script=None, row=()):
+        subargs = list(row) + self.trueArgs[1:]
+        self.env = self.setVars(subargs)
+        self.varNames = ["args"] + [ "arg{}".format(i) for i in range(1, len(subargs) + 1) ]
+        cmdline = ["qsub", "-d", os.getcwd()]
         if self.varNames:
-            cmdline += " -v " + ",".join(self.varNames)
+            cmdline += ["-v", ",".join(self.varNames)]
         if self.afterArgs:
             aspecs = [ "afterok:" + a for a in self.afterArgs ]
-            cmdline += " -W depend=" + ",".join(aspecs)
+            cmdline += ["-W", "depend=" + ",".join(aspecs)]
         if self.queue:
-            cmdline += " -q " + self.queue
+            cmdline += ["-q", self.queue]
         if self.array:
-            cmdline += " -t" + self.array
-        if self.foptions:
-            cmdline += " " + self.foptions
+            cmdline += ["-t", self.array]
+        if self.foptionsList:
+            cmdline += self.foptionsList
         if self.coptions:
-            cmdline += " " + " ".join(self.coptions)
+            cmdline += self.coptions
 
-        return cmdline + " " + " ".join(self.trueArgs)
+        if script:
+            return cmdline + [script], []
+        return cmdline, []              # qsub reads the script from stdin; args are in the env
 
 def getMode(arglist):
     """Returns the mode (currently one of `slurm' or `pbs') examining 